@@ -5,17 +5,27 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
-from os.path import abspath, join, dirname, pardir, getmtime, relpath
+from os.path import abspath, basename, join, dirname, pardir, getmtime
+import base64
+import bisect
+import collections
 import curses
+import errno
 import fcntl
 import fnmatch
-import math
+import hashlib
+import heapq
+import json
 import multiprocessing
+import multiprocessing.connection
 import os
+import pickle
+import re
+import select
 import shutil
 import signal
+import stat
 import struct
-import subprocess
 import sys
 import tempfile
 import termios
@@ -24,9 +34,50 @@ import time
 import traceback
 
 try:
-    import Queue
+    from concurrent.futures import ThreadPoolExecutor
 except ImportError:
-    import queue as Queue
+    # only available from the futures package on Python 2
+    ThreadPoolExecutor = None
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 has no scandir, emulate it with listdir and stat
+    class DirEntry(object):
+        def __init__(self, dir, name):
+            self.name = name
+            self.path = join(dir, name)
+
+        def stat(self, follow_symlinks=True):
+            return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+        def is_dir(self, follow_symlinks=True):
+            try:
+                return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+            except OSError:
+                return False
+
+        def is_file(self, follow_symlinks=True):
+            try:
+                return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+            except OSError:
+                return False
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
+
+    class scandir(object):
+        def __init__(self, path='.'):
+            self.entries = [DirEntry(path, name) for name in os.listdir(path)]
+
+        def __iter__(self):
+            return iter(self.entries)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, e, x, c):
+            pass
 
 import test_report, utils
 
@@ -51,6 +102,14 @@ argparser.add_argument('-v', '--verbose', action='store_true',
                        help='Be more verbose when running tests. Also works with -l and -L (Default: no)')
 argparser.add_argument('-t', '--timeout', type=int, default=1200,
                        help='Timeout in seconds for each test (Default: 600)')
+argparser.add_argument('--mp-context', choices=['fork', 'forkserver', 'spawn'], dest='mp_context',
+                       help='How the worker processes are started (Default: fork)')
+argparser.add_argument('--batch-size', type=int, default=1, dest='batch_size', metavar='N',
+                       help='The number of tests each worker process runs before it is replaced (Default: 1)')
+argparser.add_argument('--schedule', choices=['declared', 'lpt'], default='declared',
+                       help='The order in which the tests are started: as declared, or longest first using the durations saved by the latest run (Default: declared)')
+argparser.add_argument('--compact-results', action='store_true', dest='compact_results',
+                       help='Save the small log files of the tests in a single results.jsonl file instead of a dir per test (Default: no)')
 argparser.add_argument('-L', '--load', nargs='?', const=True, default=False, metavar='DIR',
                        help='Load logs from a previous test (Default: no)')
 argparser.add_argument('-F', '--only-failed', action='store_true', dest='only_failed',
@@ -106,7 +165,11 @@ def run(all_tests, all_groups, configure, args):
             verbose=args.verbose,
             repeat=args.repeat,
             kontinue=args.kontinue,
-            abort_fast=args.abort_fast)
+            abort_fast=args.abort_fast,
+            batch_size=args.batch_size,
+            mp_context=args.mp_context,
+            schedule=args.schedule,
+            compact_results=args.compact_results)
         testrunner.run()
         if args.html_report:
             test_report.gen_report(testrunner.dir, load_test_results_as_tests(testrunner.dir))
@@ -185,13 +248,222 @@ def old_tests_mode(all_tests, load, filter, verbose, list_tests, only_failed, tr
                     print('===', name, '===')
                     test.dump_file(name)
 
-def redirect_fd_to_file(fd, file, tee=False):
-    if not tee:
-        f = open(file, 'w')
-    else:
-        tee = subprocess.Popen(["tee", file], stdin=subprocess.PIPE)
-        f = tee.stdin
-    os.dup2(f.fileno(), fd)
+def redirect_fd_to_file(fd, file):
+    target = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    os.dup2(target, fd)
+    os.close(target)
+
+# Redirect stdout and stderr to log files in dir. With tee_fds, also copy
+# them to those two descriptors, from a process whose pid is returned. It
+# has its own process group, so that it outlives the worker and copies
+# everything until the last process writing to it is gone
+def redirect_output(dir, tee_fds=None):
+    if not tee_fds:
+        redirect_fd_to_file(1, join(dir, "stdout"))
+        redirect_fd_to_file(2, join(dir, "stderr"))
+        return None
+    pipes = {}
+    writes = []
+    for fd, name, tee_fd in [(1, "stdout", tee_fds[0]), (2, "stderr", tee_fds[1])]:
+        read, write = os.pipe()
+        writes.append((write, fd))
+        pipes[read] = (os.open(join(dir, name), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), tee_fd)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgrp()
+            keep = set(tee_fds)
+            for read, (log, tee_fd) in pipes.items():
+                keep.update([read, log])
+            close_fds_except(keep)
+            tee_output(pipes)
+        finally:
+            os._exit(0)
+    for read, (log, tee_fd) in pipes.items():
+        os.close(read)
+        os.close(log)
+    for write, fd in writes:
+        os.dup2(write, fd)
+        os.close(write)
+    return pid
+
+def tee_output(pipes):
+    while pipes:
+        for read in wait_ready(list(pipes)):
+            log, tee_fd = pipes[read]
+            data = os.read(read, 65536)
+            if not data:
+                os.close(read)
+                os.close(log)
+                del(pipes[read])
+                continue
+            write_fd(log, data)
+            try:
+                write_fd(tee_fd, data)
+            except EnvironmentError:
+                pass
+
+# Close the inherited descriptors, such as the worker's end of its pipe
+def close_fds_except(keep):
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+# The copy processes of the tests run by this worker that have not been reaped yet
+tee_pids = []
+
+# Wait up to timeout seconds for a copy process to finish, leaving it
+# running if processes left behind by the test still write to it
+def wait_tee(pid, timeout):
+    tee_pids.append(pid)
+    deadline = time.time() + timeout
+    while True:
+        for tee_pid in list(tee_pids):
+            if os.waitpid(tee_pid, os.WNOHANG)[0]:
+                tee_pids.remove(tee_pid)
+        if pid not in tee_pids or time.time() >= deadline:
+            return
+        time.sleep(0.01)
+
+def write_fd(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+# Return the last lines of a file, reading it backwards a few kilobytes at a
+# time until it has them
+def tail_file(path, count, block_size=8192):
+    if not count:
+        return []
+    blocks = []
+    newlines = 0
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            start = f.tell()
+            while start > 0 and newlines < count:
+                size = min(block_size, start)
+                start -= size
+                f.seek(start)
+                blocks.append(f.read(size))
+                newlines += blocks[-1].count(b'\n')
+    except EnvironmentError:
+        return [] # the worker may have died before creating it
+    data = b''.join(reversed(blocks))
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    lines = data.split('\n')
+    if start > 0:
+        lines = lines[1:] # the first line is probably truncated
+    return lines[-count:]
+
+# The dir in each results dir with the descriptions of its tests, skipped when loading the results
+descriptions_dir_name = '.descriptions'
+
+# With --compact-results, the log files of each test that are at most
+# compact_file_size bytes are saved in a line of the results log, in base64
+# as they may not be text
+results_log_name = 'results.jsonl'
+compact_file_names = ['stdout', 'stderr', 'fail_message', 'killed']
+compact_file_size = 1 << 20
+
+# Writes the results log from its own thread, so that reading and removing
+# the log files of a finished test does not hold up the pool's reactor
+class ResultsLog(object):
+    def __init__(self, path):
+        self.file = open(path, 'a', 1 << 20)
+        self.events = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="results-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, testprocess, status, duration):
+        self.post((testprocess, status, duration))
+
+    def close(self):
+        self.post(None)
+        self.thread.join()
+        self.file.close()
+
+    def post(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.events:
+                    self.condition.wait()
+                event = self.events.popleft()
+            if event is None:
+                return
+            testprocess, status, duration = event
+            try:
+                self.file.write(testprocess.result_record(status, duration))
+            except EnvironmentError:
+                traceback.print_exc()
+
+# The name of the file in each results dir with the duration of its tests, used by --schedule lpt
+durations_file = 'durations.tsv'
+
+def write_durations(path, durations):
+    with open(path, 'w') as file:
+        for name in sorted(durations):
+            file.write('%s\t%.3f\n' % (name, durations[name]))
+
+def read_durations(path):
+    durations = {}
+    if not path:
+        return durations
+    with open(path) as file:
+        for line in file:
+            try:
+                name, seconds = line.rstrip('\n').split('\t')
+                durations[name] = float(seconds)
+            except ValueError:
+                pass
+    return durations
+
+# The durations file of the latest run that saved one in the default results dir
+def latest_durations_file():
+    try:
+        names = os.listdir(default_test_results_dir)
+    except OSError:
+        return None
+    all_dirs = []
+    for name in names:
+        dir = join(default_test_results_dir, name)
+        try:
+            all_dirs.append((getmtime(dir), dir))
+        except OSError:
+            pass # removed since it was listed
+    for mtime, dir in sorted(all_dirs, reverse=True):
+        path = join(dir, durations_file)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# The multiprocessing context used to start the workers. With forkserver, they
+# start from a small server process instead of a copy of the whole runner
+def get_mp_context(method=None):
+    if not hasattr(multiprocessing, 'get_context'):
+        if method not in [None, 'fork']:
+            sys.exit("The %s start method needs Python 3" % (method,))
+        return multiprocessing
+    if not method:
+        method = 'fork'
+    context = multiprocessing.get_context(method)
+    if method == 'forkserver':
+        context.set_forkserver_preload(['test_framework', 'utils'])
+    return context
 
 # The main logic for running the tests
 class TestRunner(object):
@@ -201,19 +473,33 @@ class TestRunner(object):
     STARTED   = 'STARTED'
     KILLED    = 'KILLED'
 
-    def __init__(self, tests, conf, tasks=1, timeout=600, output_dir=None, verbose=False, repeat=1, kontinue=False, abort_fast = False, run_dir=None):
+    def __init__(self, tests, conf, tasks=1, timeout=600, output_dir=None, verbose=False, repeat=1, kontinue=False, abort_fast = False, run_dir=None, batch_size=1, mp_context=None, schedule='declared', compact_results=False):
+        if schedule == 'lpt':
+            # tests that have no recorded duration go first, to get one
+            durations = read_durations(latest_durations_file())
+            tests = sorted(tests, key=lambda name_test: -durations.get(name_test[0], float('inf')))
         self.tests = tests
-        self.semaphore = multiprocessing.Semaphore(tasks)
-        self.processes = []
+        self.tasks = tasks
+        self.mp = get_mp_context(mp_context)
+        # forked workers already have the tests, others are sent each one with its job
+        self.fork = not hasattr(self.mp, 'get_start_method') or self.mp.get_start_method() == 'fork'
+        self.semaphore = self.mp.Semaphore(tasks)
+        self.pool = None
         self.timeout = timeout
         self.conf = conf
         self.verbose = verbose
         self.repeat = repeat
         self.kontinue = kontinue
         self.failed_set = set()
+        self.tests_launched = set()
+        # including the tests the pool never ran because the run was aborting
+        self.tests_killed = set()
+        self.durations = {}
+        self.descriptions = set()
         self.aborting = False
         self.abort_fast = abort_fast
         self.all_passed = False
+        self.batch_size = max(batch_size, 1)
 
         timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.')
 
@@ -236,8 +522,15 @@ class TestRunner(object):
         else:
             self.run_dir = None
 
+        if compact_results:
+            self.results_log = ResultsLog(join(self.dir, results_log_name))
+        else:
+            self.results_log = None
 
-        self.running = Locked({})
+        # running is only touched by the main thread, the pool's reactor
+        # reports finished tests by appending their id to completed
+        self.running = {}
+        self.completed = collections.deque()
         if sys.stdout.isatty() and not verbose:
             self.view = TermView(total = len(self.tests) * self.repeat)
         else:
@@ -245,18 +538,18 @@ class TestRunner(object):
 
     def run(self):
         tests_count = len(self.tests)
-        tests_launched = set()
-        tests_killed = set()
         try:
             print("Running %d tests (output_dir: %s)" % (tests_count, self.dir))
 
+            self.pool = WorkerPool(self, [test for name, test in self.tests])
             for i in range(0, self.repeat):
                 if len(self.failed_set) == tests_count:
                     break
-                for name, test in self.tests:
+                for index, (name, test) in enumerate(self.tests):
                     if self.aborting:
                         break
                     self.semaphore.acquire()
+                    self.reap_completed()
                     if self.aborting:
                         self.semaphore.release()
                         break
@@ -265,11 +558,9 @@ class TestRunner(object):
                         subdir = name if self.repeat == 1 else name + '.' + str(i + 1)
                         dir = join(self.dir, subdir)
                         run_dir = join(self.run_dir, subdir) if self.run_dir else None
-                        process = TestProcess(self, id, test, dir, run_dir)
-                        with self.running as running:
-                            running[id] = process
-                        tests_launched.add(name)
+                        process = TestProcess(self, id, index, test, dir, run_dir)
                         process.start()
+                        self.pool.submit(process)
                     else:
                         self.semaphore.release()
 
@@ -284,22 +575,24 @@ class TestRunner(object):
             print('\n'.join(traceback.format_exception(exc_type, exc_value, exc_trace)))
             print("\nWaiting for tests to finish...", file=sys.stderr)
             self.wait_for_running_tests()
-        running = self.running.copy()
-        if running:
+        self.reap_completed()
+        if self.running:
             print("\nKilling remaining tasks...")
-            for id, process in running.items():
-                tests_killed.add(id)
+            for id, process in self.running.items():
                 process.terminate(gracefull_kill=True)
-            for id, process in running.items():
-                process.join()
+            if self.pool:
+                self.pool.close()
+        write_durations(join(self.dir, durations_file), self.durations)
+        if self.results_log:
+            self.results_log.close()
 
         self.view.close()
-        if len(tests_launched) != tests_count or tests_killed:
+        if len(self.tests_launched) != tests_count or self.tests_killed:
             if len(self.failed_set):
                 print("%d tests failed" % len(self.failed_set))
-            if tests_killed:
-                print("%d tests killed" % len(tests_killed))
-            print("%d tests skipped" % (tests_count - len(tests_launched)))
+            if self.tests_killed:
+                print("%d tests killed" % len(self.tests_killed))
+            print("%d tests skipped" % (tests_count - len(self.tests_launched)))
         elif len(self.failed_set):
             print("%d of %d tests failed" % (len(self.failed_set), tests_count))
         else:
@@ -308,21 +601,19 @@ class TestRunner(object):
         print("Saved test results to %s" % self.dir)
 
     def wait_for_running_tests(self):
-        # loop through the remaining TestProcesses and wait for them to finish
-        while True:
-            with self.running as running:
-                if not running:
-                    break
-                id, process = list(running.items())[0]
-            process.join()
-            with self.running as running:
-                try:
-                    del(running[id])
-                except KeyError:
-                    pass
-                else:
-                    process.write_fail_message("Test failed to report success or failure status")
-                    self.tell(self.FAILED, id)
+        # let the workers finish the tests they were given, then fail the tests that never reported
+        if self.pool:
+            self.pool.close()
+        self.reap_completed()
+        # tell only queues the ids for reap_completed, so running can be iterated without a copy
+        for id, process in self.running.items():
+            process.write_fail_message("Test failed to report success or failure status")
+            self.tell(self.FAILED, id, process)
+        self.reap_completed()
+
+    def reap_completed(self):
+        while self.completed:
+            del(self.running[self.completed.popleft()])
 
     def tell(self, status, id, testprocess):
         name = id[0]
@@ -332,9 +623,18 @@ class TestRunner(object):
                 args = dict(error = testprocess.tail_error())
             if self.abort_fast:
                 self.aborting = True
-        if status != 'STARTED':
-            with self.running as running:
-                del(running[id])
+        if status == 'STARTED':
+            self.running[id] = testprocess
+            self.tests_launched.add(name)
+        else:
+            self.completed.append(id)
+            duration = time.time() - testprocess.start_time
+            if status != 'KILLED':
+                self.durations[name] = duration
+            else:
+                self.tests_killed.add(id)
+            if self.results_log:
+                self.results_log.log(testprocess, status, duration)
             if status not in ['SUCCESS', 'KILLED']:
                 self.view.tell('CANCEL', self.repeat - id[1] - 1)
                 self.failed_set.add(name)
@@ -342,32 +642,70 @@ class TestRunner(object):
         self.view.tell(status, name, **args)
 
     def count_running(self):
-        with self.running as running:
-            return len(running)
+        if not self.pool:
+            return 0
+        return sum(1 for worker in self.pool.workers if worker.current)
 
     def failed(self):
         return not self.all_passed
 
-# For printing the status of TestRunner to stdout
-class TextView(object):
-    
+# The terminal control strings, looked up the first time a view needs them
+class Terminal(object):
+    loaded = False
+    use_color = False
     red = ''
     green = ''
     yellow = ''
     nocolor = ''
+    clear_line = None
+
+    @classmethod
+    def load(cls):
+        if cls.loaded:
+            return cls
+        cls.loaded = True
+        cls.use_color = utils.supportsTerminalColors()
+        try:
+            curses.setupterm()
+            if cls.use_color:
+                setf = curses.tigetstr('setaf') or b''
+                bold = curses.tigetstr('bold') or b''
+                cls.red = terminal_string((curses.tparm(setf, 1) if setf else b'') + bold)
+                cls.green = terminal_string((curses.tparm(setf, 2) if setf else b'') + bold)
+                cls.yellow = terminal_string((curses.tparm(setf, 3) if setf else b'') + bold)
+                cls.nocolor = terminal_string(curses.tigetstr('sgr0') or b'')
+            cls.clear_line = terminal_string(curses.tigetstr('cr') + (curses.tigetstr('dl1') or curses.tigetstr('el')))
+        except Exception: pass
+        return cls
+
+# curses returns bytes on Python 3
+def terminal_string(value):
+    if not isinstance(value, str):
+        value = value.decode('latin-1')
+    return value
+
+# For printing the status of TestRunner to stdout
+class TextView(object):
     
     def __init__(self):
-        self.use_color = utils.supportsTerminalColors()
+        terminal = Terminal.load()
+        self.use_color = terminal.use_color
+        self.red = terminal.red
+        self.green = terminal.green
+        self.yellow = terminal.yellow
+        self.nocolor = terminal.nocolor
+        short = dict(
+            FAILED    = (self.red    , "FAIL"),
+            SUCCESS   = (self.green  , "OK  "),
+            TIMED_OUT = (self.red    , "TIME"),
+            KILLED    = (self.yellow , "KILL")
+        )
         if self.use_color:
-            try:
-                curses.setupterm()
-                setf = curses.tigetstr('setaf') or ''
-                bold = curses.tigetstr('bold') or ''
-                self.red = (curses.tparm(setf, 1) if setf != '' else '') + bold 
-                self.green = (curses.tparm(setf, 2) if setf != '' else '') + bold
-                self.yellow = (curses.tparm(setf, 3) if setf != '' else '') + bold
-                self.nocolor = curses.tigetstr('sgr0') or ''
-            except Exception: pass
+            self.short = dict((event, color + text + " ") for event, (color, text) in short.items())
+            self.end_event = self.nocolor
+        else:
+            self.short = dict((event, text + " ") for event, (color, text) in short.items())
+            self.end_event = ''
 
     def tell(self, event, name, **args):
         if event not in ['STARTED', 'CANCEL']:
@@ -376,17 +714,7 @@ class TextView(object):
     def format_event(self, str, name, error=None):
         if str == 'LOG':
             return name
-        short = dict(
-            FAILED    = (self.red    , "FAIL"),
-            SUCCESS   = (self.green  , "OK  "),
-            TIMED_OUT = (self.red    , "TIME"),
-            KILLED    = (self.yellow , "KILL")
-        )[str]
-        buf = ''
-        if self.use_color:
-            buf += short[0] + short[1] + " " + name + self.nocolor
-        else:
-            buf += short[1] + " " + name
+        buf = self.short[str] + name + self.end_event
         if error:
             buf += '\n' + error
         return buf
@@ -409,13 +737,17 @@ class TermView(TextView):
         self.failed = 0
         self.total = total
         self.start_time = time.time()
-        self.printingQueue = Queue.Queue()
+        # events for the printing thread, which otherwise only wakes up
+        # when the duration shown in the status line changes
+        self.events = collections.deque()
+        self.condition = threading.Condition()
         
         try:
             # curses.setupterm is already called in super's init
             self.columns = struct.unpack('hh', fcntl.ioctl(1, termios.TIOCGWINSZ, '1234'))[1]
             signal.signal(signal.SIGWINCH, lambda *args: self.tell('SIGWINCH', args))
-            self.clear_line = curses.tigetstr('cr') + (curses.tigetstr('dl1') or curses.tigetstr('el'))
+            if Terminal.clear_line:
+                self.clear_line = Terminal.clear_line
         except Exception: pass
         
         self.thread = threading.Thread(target=self.run, name='TermView')
@@ -423,25 +755,40 @@ class TermView(TextView):
         self.thread.start()
 
     def tell(self, *args, **kwargs):
-        self.printingQueue.put((args, kwargs))
+        self.post((args, kwargs))
 
     def close(self):
-        self.printingQueue.put(('EXIT',None))
+        self.post(('EXIT',None))
         self.thread.join()
 
+    def post(self, event):
+        # the condition's lock is reentrant, so the SIGWINCH handler can post
+        # from the main thread while it is posting another event
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify()
+
     def run(self):
         while True:
-            try:
-                args, kwargs = self.printingQueue.get(timeout=1)
-            except Queue.Empty:
-                if self.clear_line != self.__class__.clear_line: # if we can't clear the line, don't print every second
-                    self.update_status()
-                    self.flush()
-            else:
+            with self.condition:
+                if not self.events:
+                    self.condition.wait(self.next_tick())
+                events = list(self.events)
+                self.events.clear()
+            if not events:
+                self.update_status()
+                self.flush()
+            for args, kwargs in events:
                 if args == 'EXIT':
-                    break
+                    return
                 self.thread_tell(*args, **kwargs)
 
+    # The time until the status line shows a new duration, or None if it needs no redrawing
+    def next_tick(self):
+        if not self.running_list or self.clear_line == self.__class__.clear_line: # if we can't clear the line, don't print every second
+            return None
+        return 1 - (time.time() - self.start_time) % 1
+
     def thread_tell(self, event, name, **kwargs):
         if event == 'SIGWINCH':
             self.columns = struct.unpack('hh', fcntl.ioctl(1, termios.TIOCGWINSZ, '1234'))[1]
@@ -485,25 +832,26 @@ class TermView(TextView):
                 
                 return '[%s/%s/%d/%d %s%s]' % (strPassed, strFailed, running, remaining, duration, names)
             
-            names = ''
             charsAvailable = self.columns - self.statusPadding - len(format('', useColor=False))
-            testsToList = 0
-            while testsToList <= running:
-                canidateNames = ' ' + self.format_running(testsToList)
-                if len(canidateNames) <= charsAvailable:
-                    names = canidateNames
-                else:
-                    break 
-                testsToList += 1
+            # widths[i] is the length of ' ' + self.format_running(i), which ends with ', ...'
+            widths = []
+            namesLength = 0
+            for i, name in enumerate(self.running_list):
+                widths.append(namesLength + 2 * i + 4)
+                namesLength += len(name)
+            testsToList = bisect.bisect_right(widths, charsAvailable)
+            if testsToList == running and namesLength + 2 * running - 1 <= charsAvailable:
+                names = ' ' + self.format_running(running)
+            elif testsToList:
+                names = ' ' + self.format_running(testsToList - 1)
+            else:
+                names = ''
             
             self.buffer += format(names)
 
     def format_duration(self, elapsed):
-        elapsed = math.floor(elapsed)
-        seconds = elapsed % 60
-        elapsed = math.floor(elapsed / 60)
-        minutes = elapsed % 60
-        hours = math.floor(elapsed / 60)
+        minutes, seconds = divmod(int(elapsed), 60)
+        hours, minutes = divmod(minutes, 60)
         ret = "%ds" % (seconds,)
         if minutes or hours:
             ret = "%dm%s" % (minutes, ret)
@@ -512,16 +860,10 @@ class TermView(TextView):
         return ret
 
     def format_running(self, max):
-        ret = ''
-        for i in range(max):
-            if i > 0:
-                ret += ', '
-            ret += self.running_list[i]
+        names = self.running_list[:max]
         if len(self.running_list) > max:
-            if max > 0:
-                ret += ', '
-            ret += "..."
-        return ret
+            names.append("...")
+        return ', '.join(names)
 
     def show(self, line):
         self.clear_status()
@@ -533,78 +875,73 @@ class TermView(TextView):
         self.buffer = ''
         sys.stdout.flush()
 
-# Lock access to an object with a lock
-class Locked(object):
-    def __init__(self, value=None):
-        self.value = value
-        self.lock = threading.Lock()
-
-    def __enter__(self):
-        self.lock.acquire()
-        return self.value
-
-    def __exit__(self, e, x, c):
-        self.lock.release()
-
-    def copy(self):
-        with self as value:
-            return value.copy()
-
-# Run a single test in a separate process
+# A single test, run by one of the workers of a WorkerPool
 class TestProcess(object):
-    def __init__(self, runner, id, test, dir, run_dir):
+    def __init__(self, runner, id, index, test, dir, run_dir):
         self.runner = runner
         self.id = id
         self.name = id[0]
+        self.index = index
         self.test = test
         self.timeout = test.timeout() or runner.timeout
-        self.supervisor = None
-        self.process = None
+        self.worker = None
+        self.start_time = None
         self.dir = abspath(dir)
         self.run_dir = abspath(run_dir) if run_dir else None
-        self.gracefull_kill = False
-        self.terminate_thread = None
 
     def start(self):
+        self.start_time = time.time()
+        self.runner.tell(TestRunner.STARTED, self.id, self)
+        os.mkdir(self.dir)
+        if self.run_dir:
+            os.mkdir(self.run_dir)
+        if not self.runner.results_log:
+            self.write_description()
+
+    # Tests repeated with --repeat share their description: it is written
+    # once to the results dir and linked from each test's log dir. Without
+    # --repeat, the description is a plain file, so each log dir stands alone
+    def write_description(self):
+        description = str(self.test)
+        if not isinstance(description, bytes):
+            description = description.encode('utf-8')
+        if self.runner.repeat == 1:
+            with open(join(self.dir, "description"), 'wb') as file:
+                file.write(description)
+            return
+        digest = hashlib.sha1(description).hexdigest()
+        if digest not in self.runner.descriptions:
+            descriptions_dir = join(self.runner.dir, descriptions_dir_name)
+            if not self.runner.descriptions:
+                os.mkdir(descriptions_dir)
+            with open(join(descriptions_dir, digest), 'wb') as file:
+                file.write(description)
+            self.runner.descriptions.add(digest)
+        os.symlink(join(os.pardir, descriptions_dir_name, digest), join(self.dir, "description"))
+
+    def job(self):
+        test = None if self.runner.fork else self.test
+        return (self.index, test, self.dir, self.run_dir, self.timeout, self.runner.verbose)
+
+    # The line of the results log for the finished test, with its small log
+    # files, which are removed along with its dir unless it left other files
+    def result_record(self, status, duration):
+        description = str(self.test)
+        if not isinstance(description, bytes):
+            description = description.encode('utf-8')
+        files = {'description': base64.b64encode(description).decode('ascii')}
+        with scandir(self.dir) as entries:
+            for entry in entries:
+                if entry.name in compact_file_names and entry.is_file(follow_symlinks=False) and entry.stat().st_size <= compact_file_size:
+                    with open(entry.path, 'rb') as file:
+                        files[entry.name] = base64.b64encode(file.read()).decode('ascii')
+                    os.remove(entry.path)
         try:
-            self.runner.tell(TestRunner.STARTED, self.id, self)
-            os.mkdir(self.dir)
-            if self.run_dir:
-                os.mkdir(self.run_dir)
-            with open(join(self.dir, "description"), 'w') as file:
-                file.write(str(self.test))
-
-            self.supervisor = threading.Thread(target=self.supervise, name="supervisor:" + self.name)
-            self.supervisor.daemon = True
-            self.supervisor.start()
-        except Exception:
-            raise
-
-    def run(self, write_pipe):
-        def recordSignal(signum, frame):
-            print('Ignored signal SIGINT')
-        signal.signal(signal.SIGINT, recordSignal) # avoiding a problem where signal.SIG_IGN would cause the test to never stop
-        sys.stdin.close()
-        redirect_fd_to_file(1, join(self.dir, "stdout"), tee=self.runner.verbose)
-        redirect_fd_to_file(2, join(self.dir, "stderr"), tee=self.runner.verbose)
-        os.chdir(self.run_dir or self.dir)
-        os.setpgrp()
-        with Timeout(self.timeout):
-            try:
-                self.test.run()
-            except TimeoutException:
-                write_pipe.send(TestRunner.TIMED_OUT)
-            except:
-                sys.stdout.write(traceback.format_exc() + '\n')
-                sys.stderr.write(str(sys.exc_info()[1]) + '\n')
-                write_pipe.send(TestRunner.FAILED)
-            else:
-                write_pipe.send(TestRunner.SUCCESS)
-            finally:
-                if self.run_dir:
-                    for file in os.listdir(self.run_dir):
-                        shutil.move(join(self.run_dir, file), join(self.dir, file))
-                    os.rmdir(self.run_dir)
+            os.rmdir(self.dir)
+        except OSError:
+            pass
+        record = dict(name=basename(self.dir), status=status, duration=round(duration, 3), files=files)
+        return json.dumps(record) + '\n'
 
     def write_fail_message(self, message):
         with open(join(self.dir, "stderr"), 'a') as file:
@@ -613,73 +950,394 @@ class TestProcess(object):
             file.write(message)
 
     def tail_error(self):
-        with open(join(self.dir, "stderr")) as f:
-            lines = f.read().split('\n')[-10:]
+        lines = tail_file(join(self.dir, "stderr"), 10)
         if len(lines) < 10:
-            with open(join(self.dir, "stdout")) as f:
-                lines = f.read().split('\n')[-len(lines):] + lines
+            lines = tail_file(join(self.dir, "stdout"), len(lines)) + lines
         return '\n'.join(lines)
 
-    def supervise(self):
-        read_pipe, write_pipe = multiprocessing.Pipe(False)
-        self.process = multiprocessing.Process(target=self.run, args=[write_pipe], name="subprocess:" + self.name)
-        self.process.start()
-        self.process.join(self.timeout + 5)
-        if self.terminate_thread:
-            self.terminate_thread.join()
-        if self.gracefull_kill:
-            with open(join(self.dir, "killed"), "a") as file:
-                file.write("Test killed")
-            self.runner.tell(TestRunner.KILLED, self.id, self)
-        elif self.process.is_alive():
-            self.terminate()
-            self.terminate_thread.join()
-            self.write_fail_message("Test failed to exit after timeout of %d seconds" % self.timeout)
-            self.runner.tell(TestRunner.FAILED, self.id, self)
-        elif self.process.exitcode:
-            self.write_fail_message("Test exited abnormally with error code %d" % self.process.exitcode)
-            self.runner.tell(TestRunner.FAILED, self.id, self)
-        else:
+    def terminate(self, gracefull_kill=False):
+        worker = self.worker
+        if worker:
+            worker.terminate(self, gracefull_kill)
+
+# The main loop of a worker process: run at most batch_size of the tests it
+# is sent one after the other, then exit without reading from the pipe again
+def worker_loop(pipe, tests, batch_size):
+    def recordSignal(signum, frame):
+        print('Ignored signal SIGINT')
+    signal.signal(signal.SIGINT, recordSignal) # avoiding a problem where signal.SIG_IGN would cause the test to never stop
+    sys.stdin.close()
+    os.setpgrp()
+    terminal_fds = (os.dup(1), os.dup(2))
+    for i in range(batch_size):
+        job = pipe.recv()
+        if job is None:
+            break
+        index, test, dir, run_dir, timeout, verbose = job
+        if test is None:
+            test = tests[index]
+        pipe.send(run_test(test, dir, run_dir, timeout, terminal_fds if verbose else None))
+
+# Run a single test inside a worker process and return its status
+def run_test(test, dir, run_dir, timeout, tee_fds=None):
+    tee = redirect_output(dir, tee_fds)
+    os.chdir(run_dir or dir)
+    try:
+        with Timeout(timeout):
             try:
-                write_pipe.close()
-                status = read_pipe.recv()
-            except EOFError:
-                self.write_fail_message("Test did not fail, but"
-                                        " failed to report its success")
-                status = TestRunner.FAILED
+                test.run()
+            except TimeoutException:
+                return TestRunner.TIMED_OUT
+            except:
+                sys.stdout.write(traceback.format_exc() + '\n')
+                sys.stderr.write(str(sys.exc_info()[1]) + '\n')
+                return TestRunner.FAILED
             else:
-                if status != TestRunner.SUCCESS:
-                    with open(join(self.dir, "fail_message"), 'a') as file:
-                        file.write('Failed')
-            self.runner.tell(status, self.id, self)
+                return TestRunner.SUCCESS
+            finally:
+                if run_dir:
+                    move_run_dir(run_dir, dir)
+    finally:
+        # the next test run by this worker gets its own stdout and stderr
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if tee:
+            redirect_fd_to_file(1, os.devnull)
+            redirect_fd_to_file(2, os.devnull)
+            wait_tee(tee, 1)
+
+# Move the files a test left in its run_dir to its log dir, and remove the run_dir
+def move_run_dir(run_dir, dir):
+    try:
+        os.rmdir(run_dir)
+        return
+    except OSError as e:
+        if e.errno not in [errno.ENOTEMPTY, errno.EEXIST]:
+            raise
+    # run_dir is usually on another partition than the log dir
+    move = os.rename if os.stat(run_dir).st_dev == os.stat(dir).st_dev else shutil.move
+    with scandir(run_dir) as entries:
+        for entry in entries:
+            move(entry.path, join(dir, entry.name))
+    os.rmdir(run_dir)
+
+# Long-lived worker processes that the TestRunner hands its tests to. A
+# single reactor thread supervises all of them
+class WorkerPool(object):
+    def __init__(self, runner, tests):
+        self.runner = runner
+        self.tests = tests
+        self.jobs = collections.deque()
+        self.closed = False
+        # the main thread writes a byte to wakeup when it submits a test or
+        # closes the pool, the reactor writes one to finished when it exits
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.finished_read, self.finished_write = os.pipe()
+        # a heap of (deadline, worker index), stale entries are skipped
+        self.deadlines = []
+        self.exiting = []
+        # the (worker, test, gracefull_kill) the main thread asked to kill
+        self.kills = collections.deque()
+        self.workers = [Worker(self, i) for i in range(runner.tasks)]
+        self.reactor = threading.Thread(target=self.react, name="reactor")
+        self.reactor.daemon = True
+        self.reactor.start()
+
+    def submit(self, testprocess):
+        self.jobs.append(testprocess)
+        os.write(self.wakeup_write, b'.')
 
-    def join(self):
-        while self.supervisor.is_alive():
-            self.supervisor.join(1)
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.write(self.wakeup_write, b'.')
+        wait_ready([self.finished_read])
+        self.reactor.join()
+
+    def kill(self, worker, test, gracefull_kill):
+        self.kills.append((worker, test, gracefull_kill))
+        os.write(self.wakeup_write, b'.')
+
+    def schedule(self, worker, delay):
+        worker.deadline = time.time() + delay
+        heapq.heappush(self.deadlines, (worker.deadline, worker.index))
+
+    # Remember a worker process that was asked to exit, so it can be joined at the end
+    def retire(self, process):
+        self.exiting = [exiting for exiting in self.exiting if exiting.is_alive()]
+        self.exiting.append(process)
+
+    def react(self):
+        try:
+            while True:
+                for worker in self.workers:
+                    if self.jobs and not worker.current:
+                        self.handle(worker, worker.run, self.jobs.popleft())
+                busy = [worker for worker in self.workers if worker.current]
+                if self.closed and not self.jobs and not busy:
+                    break
+                waitables = {self.wakeup_read: None}
+                for worker in busy:
+                    if worker.signals is None:
+                        waitables[worker.pipe] = worker
+                        # a crashed worker's pipe stays open as long as
+                        # the processes it started are alive
+                        if hasattr(worker.process, 'sentinel'):
+                            waitables[worker.process.sentinel] = worker
+                timeout = None
+                if self.deadlines:
+                    timeout = max(self.deadlines[0][0] - time.time(), 0)
+                for ready in wait_ready(list(waitables), timeout):
+                    if waitables[ready]:
+                        self.handle(waitables[ready], waitables[ready].check)
+                    else:
+                        os.read(self.wakeup_read, 4096)
+                while self.kills:
+                    worker, test, gracefull_kill = self.kills.popleft()
+                    self.handle(worker, worker.kill, test, gracefull_kill)
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, index = heapq.heappop(self.deadlines)
+                    worker = self.workers[index]
+                    if worker.deadline == deadline:
+                        self.handle(worker, worker.expired)
+            for worker in self.workers:
+                if worker.process:
+                    worker.stop()
+            for process in self.exiting:
+                process.join()
+        finally:
+            os.write(self.finished_write, b'.')
+
+    # An error while handling one worker only fails its test, instead of
+    # stopping the reactor and leaving the runner waiting for every test
+    def handle(self, worker, method, *args):
+        try:
+            method(*args)
+        except Exception:
+            worker.crashed(traceback.format_exc())
+
+# One worker process, replaced when it dies or after it ran batch_size tests.
+# All the methods except terminate are called from the pool's reactor thread
+class Worker(object):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.runner = pool.runner
+        self.index = index
+        self.name = "worker:%d" % (index,)
+        self.process = None
+        self.pipe = None
+        self.child_pipe = None
+        self.current = None
+        self.deadline = None
+        self.tests_run = 0
+        self.timed_out = False
+        # while the worker is being killed, the signals left to send and
+        # how many more times to check whether its process group is gone
+        self.signals = None
+        self.polls = 0
+        self.gracefull_kill = False
 
-    def terminate_thorough(self):
+    def run(self, test):
+        test.worker = self
+        if self.runner.aborting:
+            self.report_killed(test)
+            return
+        self.current = test
+        self.timed_out = False
         if not self.process:
+            self.spawn()
+        self.pool.schedule(self, test.timeout + 5)
+        try:
+            self.pipe.send(test.job())
+        except (EnvironmentError, EOFError):
+            # noticed by check once the worker is gone
+            pass
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # nothing was sent, the worker is still waiting for a test
+            self.current = None
+            self.deadline = None
+            test.write_fail_message("Test cannot be sent to a %s worker: %s" % (self.runner.mp.get_start_method(), e))
+            self.runner.tell(TestRunner.FAILED, test.id, test)
+
+    # The pipe is handed down to the next worker process, until one dies
+    # and may have left half a message in it
+    def spawn(self):
+        if not self.pipe:
+            self.pipe, self.child_pipe = self.runner.mp.Pipe()
+        self.tests_run = 0
+        self.process = self.runner.mp.Process(target=worker_loop, args=[self.child_pipe, self.pool.tests if self.runner.fork else None, self.runner.batch_size], name="subprocess:" + self.name)
+        self.process.start()
+        if not hasattr(self.process, 'sentinel'):
+            # the pipe closing is then the only way to notice the worker dying
+            self.child_pipe.close()
+            self.child_pipe = None
+
+    def close_pipe(self):
+        for pipe in [self.pipe, self.child_pipe]:
+            if pipe:
+                pipe.close()
+        self.pipe = None
+        self.child_pipe = None
+
+    # The worker exits by itself after batch_size tests
+    def retire(self):
+        self.pool.retire(self.process)
+        self.process = None
+        if not self.child_pipe:
+            self.close_pipe()
+
+    def stop(self):
+        try:
+            self.pipe.send(None)
+        except (EnvironmentError, EOFError):
+            pass
+        self.retire()
+
+    # Called when the worker's pipe or sentinel is ready: the worker
+    # either reported the status of its test or died
+    def check(self):
+        if not self.current or self.signals is not None:
             return
-        pid = self.process.pid
-        self.process.terminate()
-        self.process.join(5)
-        for sig in [signal.SIGTERM, signal.SIGABRT, signal.SIGKILL]:
-            try:
-                os.killpg(pid, sig)
-            except OSError:
-                break
-            time.sleep(2)
+        status = None
+        try:
+            if self.pipe.poll():
+                status = self.pipe.recv()
+        except (EnvironmentError, EOFError):
+            pass
+        if status is None:
+            self.lost()
+            return
+        test = self.current
+        self.current = None
+        self.deadline = None
+        if status != TestRunner.SUCCESS:
+            with open(join(test.dir, "fail_message"), 'a') as file:
+                file.write('Failed')
+        self.runner.tell(status, test.id, test)
+        self.tests_run += 1
+        if self.tests_run >= self.runner.batch_size:
+            self.retire()
+
+    def expired(self):
+        self.deadline = None
+        if self.signals is not None:
+            self.escalate()
+        else:
+            self.timed_out = True
+            self.lost()
 
-    def terminate(self, gracefull_kill=False):
+    # The worker died or timed out without reporting the status of its test
+    def lost(self):
+        if self.timed_out or self.gracefull_kill:
+            self.start_killing()
+        else:
+            self.report_lost()
+
+    # The main thread asked for the test to be killed, which starts right
+    # away unless the worker already moved on from it
+    def kill(self, test, gracefull_kill):
         if gracefull_kill:
             self.gracefull_kill = True
-        if self.terminate_thread:
+        if self.current is test and self.signals is None:
+            self.deadline = None
+            self.start_killing()
+
+    def start_killing(self):
+        self.signals = [signal.SIGTERM, signal.SIGABRT, signal.SIGKILL]
+        self.polls = 0
+        # the worker may not have called setpgrp yet
+        self.process.terminate()
+        self.escalate()
+
+    # Kill the worker's process group one signal at a time, checking every
+    # 50ms for up to a second whether it is gone before sending the next one.
+    # The worker is reaped with is_alive() rather than waitpid, which would
+    # confuse multiprocessing
+    def escalate(self):
+        self.process.is_alive()
+        pid = self.process.pid
+        try:
+            if self.polls:
+                self.polls -= 1
+                os.killpg(pid, 0)
+            elif self.signals:
+                os.killpg(pid, self.signals.pop(0))
+                self.polls = 20
+            else:
+                self.report_lost()
+                return
+        except OSError:
+            self.report_lost()
             return
-        self.terminate_thread = threading.Thread(target=self.terminate_thorough, name='terminate:' + self.name)
-        self.terminate_thread.start()
-
-    def pid(self):
-        return self.process.pid
+        self.pool.schedule(self, 0.05)
+
+    def report_lost(self):
+        test = self.current
+        process = self.process
+        self.current = None
+        self.deadline = None
+        self.signals = None
+        self.process = None
+        self.close_pipe()
+        process.join()
+        if self.gracefull_kill:
+            self.report_killed(test)
+        elif self.timed_out:
+            test.write_fail_message("Test failed to exit after timeout of %d seconds" % test.timeout)
+            self.runner.tell(TestRunner.FAILED, test.id, test)
+        elif process.exitcode:
+            test.write_fail_message("Test exited abnormally with error code %d" % process.exitcode)
+            self.runner.tell(TestRunner.FAILED, test.id, test)
+        else:
+            test.write_fail_message("Test did not fail, but"
+                                    " failed to report its success")
+            self.runner.tell(TestRunner.FAILED, test.id, test)
+
+    # Replace the worker after an error in the reactor, failing its test
+    # unless it was already reported
+    def crashed(self, error):
+        test = self.current
+        process = self.process
+        self.current = None
+        self.deadline = None
+        self.signals = None
+        self.process = None
+        self.close_pipe()
+        if process and process.pid:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass # the worker may not have called setpgrp yet
+            process.terminate()
+            self.pool.retire(process)
+        if test:
+            try:
+                test.write_fail_message("Error in the test runner while running the test:\n" + error)
+            except EnvironmentError:
+                pass
+            self.runner.tell(TestRunner.FAILED, test.id, test)
+
+    def report_killed(self, test):
+        with open(join(test.dir, "killed"), "a") as file:
+            file.write("Test killed")
+        self.runner.tell(TestRunner.KILLED, test.id, test)
+
+    # Called from the main thread: the reactor kills the worker's process
+    # group, one signal after the other
+    def terminate(self, test, gracefull_kill=False):
+        self.pool.kill(self, test, gracefull_kill)
+
+# Wait until one of the connections, sentinels or file descriptors is ready to be read
+def wait_ready(waitables, timeout=None):
+    if hasattr(multiprocessing.connection, 'wait'):
+        return multiprocessing.connection.wait(waitables, timeout)
+    while True:
+        try:
+            return select.select(waitables, [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
 
 class TimeoutException(Exception):
     pass
@@ -730,6 +1388,7 @@ class TestFilter(object):
         self.tree = {}
         self.was_matched = False
         self.group = group
+        self.default_subfilter = None
 
     @classmethod
     def parse(self, args, groups, group=None):
@@ -756,11 +1415,12 @@ class TestFilter(object):
         return filter
 
     def combine(self, type, other):
-        for name in set(self.tree.keys() + other.tree.keys()):
+        for name in set(self.tree).union(other.tree):
             self.zoom(name, create=True).combine(type, other.zoom(name))
         if other.default == self.INCLUDE:
             self.default = type
         self.group = self.group.combined(other.group)
+        self.default_subfilter = None
 
     def at(self, path):
         if not path:
@@ -772,6 +1432,7 @@ class TestFilter(object):
         self.group.weak = self.group.weak and weak
         self.default = type
         self.tree = {}
+        self.default_subfilter = None
 
     def match(self, test=None):
         self.was_matched = True
@@ -781,10 +1442,15 @@ class TestFilter(object):
         try:
             return self.tree[name]
         except KeyError:
+            pass
+        if create:
             subfilter = TestFilter(self.default, group=self.group.copy())
-            if create:
-                self.tree[name] = subfilter
+            self.tree[name] = subfilter
             return subfilter
+        # the names that are not in the tree all share the same filter
+        if not self.default_subfilter:
+            self.default_subfilter = TestFilter(self.default, group=self.group.copy())
+        return self.default_subfilter
 
     def check_use(self, path=[]):
         if not self.was_matched:
@@ -860,6 +1526,10 @@ class SimpleTest(Test):
 class TestTree(Test):
     def __init__(self, tests={}):
         self.tests = dict(tests)
+        self._sorted_items = None
+
+    def _changed(self):
+        self._sorted_items = None
 
     def filter(self, filter):
         if filter.all_same():
@@ -881,7 +1551,8 @@ class TestTree(Test):
         return self.tests[name]
 
     def __setitem__(self, name, test):
-        if not test or (isinstance(test, TestTree) and not test.tests):
+        self._changed()
+        if test is None or (isinstance(test, TestTree) and not test.tests):
             try:
                 del(self.tests[name])
             except KeyError:
@@ -889,18 +1560,34 @@ class TestTree(Test):
         else:
             self.tests[name] = test
 
+    def __delitem__(self, name):
+        self._changed()
+        del(self.tests[name])
+
     def add(self, name, test):
         if name in self.tests:
             raise Exception('Test already exists: %s' % (name,))
+        self._changed()
         self.tests[name] = test
 
+    # The (name, test) pairs of the tree, sorted by name
+    def sorted_items(self):
+        if self._sorted_items is None:
+            self._sorted_items = sorted(self.tests.items(), key=lambda item: item[0])
+        return self._sorted_items
+
+    # Depth first, without a nested generator for each level of the tree
     def __iter__(self):
-        for name in sorted(self.tests.keys()):
-            for subname, test in self.tests[name]:
-                if subname:
-                    yield (name + '.' + subname, test)
-                else:
-                    yield name, test
+        stack = [('', iter(self.sorted_items()))]
+        while stack:
+            prefix, items = stack[-1]
+            for name, test in items:
+                if isinstance(test, TestTree):
+                    stack.append((prefix + name + '.', iter(test.sorted_items())))
+                    break
+                yield prefix + name, test
+            else:
+                stack.pop()
 
     def requirements(self):
         for test in self.tests.values():
@@ -908,62 +1595,106 @@ class TestTree(Test):
                 yield req
 
     def configure(self, conf):
-        return TestTree({test: self.tests[test].configure(conf) for test in self.tests})
+        return TestTree({name: test.configure(conf) for name, test in self.tests.items()})
 
     def __len__(self):
-        count = 0
-        for __, ___ in self:
-            count += 1
-        return count
+        return sum(len(test) if isinstance(test, TestTree) else 1 for test in self.tests.values())
 
     def has_test(self, name):
         return name in self.tests
 
+# The number of old tests from which they are loaded in parallel
+load_threshold = 64
+
 # Used with `--load' to load old test results
 def load_test_results_as_tests(path):
     tests = TestTree()
-    for dir in os.listdir(path):
-        full_dir = join(path, dir)
-        if not os.path.isdir(full_dir):
-            continue
-        names = list(reversed(dir.split('.')))
-        parent = tests
-        while parent.has_test(names[-1]):
-            parent = parent[names[-1]]
-            names.pop()
-        test = OldTest(full_dir)
-        for name in names[:-1]:
-            test = TestTree({name: test})
-        parent[names[-1]] = test
+    records = {}
+    results_log = join(path, results_log_name)
+    if os.path.isfile(results_log):
+        with open(results_log) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # the last line of an interrupted run may be truncated
+                records[record['name']] = record
+    old_tests = [(dir, CompactTest(join(path, dir), record)) for dir, record in records.items()]
+    with scandir(path) as entries:
+        for entry in entries:
+            if entry.name == descriptions_dir_name or entry.name in records or not entry.is_dir():
+                continue
+            old_tests.append((entry.name, OldTest(entry.path)))
+    # list the dirs of the tests from several threads, which mostly wait
+    # on the filesystem, before they are asked whether they passed
+    if ThreadPoolExecutor and len(old_tests) >= load_threshold:
+        with ThreadPoolExecutor(16) as executor:
+            list(executor.map(lambda dir_test: dir_test[1]._entries, old_tests))
+    for dir, test in old_tests:
+        add_old_test(tests, dir, test)
     return tests
 
+def add_old_test(tests, dir, test):
+    names = list(reversed(dir.split('.')))
+    parent = tests
+    while True:
+        child = parent.tests.get(names[-1])
+        if child is None:
+            break
+        parent = child
+        names.pop()
+    for name in names[:-1]:
+        test = TestTree({name: test})
+    parent[names[-1]] = test
+
 # A test that has already run
 class OldTest(Test):
     def __init__(self, dir, **kwargs):
         Test.__init__(self, **kwargs)
         self.dir = dir
+        self._entries_cache = None
+        self._description = None
+
+    # The names in the test's dir, listed once
+    @property
+    def _entries(self):
+        if self._entries_cache is None:
+            try:
+                self._entries_cache = frozenset(os.listdir(self.dir))
+            except OSError:
+                self._entries_cache = frozenset()
+        return self._entries_cache
 
     def __str__(self):
-        return self.read_file('description', 'unknown test')
+        if self._description is None:
+            self._description = self.read_file('description', 'unknown test')
+        return self._description
 
     def read_file(self, name, default=None):
+        # most missing files are known from the listing of the test's dir
+        if os.sep not in name and name not in self._entries:
+            return default
         try:
-            with open(join(self.dir, name)) as file:
-                return file.read()
-        except Exception as e:
-            # TODO: catch the right exception here
+            with open(join(self.dir, name), 'rb', 65536) as file:
+                data = file.read()
+        except EnvironmentError:
             return default
+        # logs may contain anything, don't let that fail a report on Python 3
+        return data if isinstance(data, str) else data.decode('utf-8', 'replace')
 
     def passed(self):
-        return not os.path.exists(join(self.dir, "fail_message"))
+        return "fail_message" not in self._entries
 
     def killed(self):
-        return os.path.exists(join(self.dir, "killed"))
+        return "killed" in self._entries
 
     def dump_file(self, name):
-        with file(join(self.dir, name)) as f:
-            for line in f:
-                print(line, end=' ')
+        # copy the raw bytes in large chunks, past the text layer on Python 3
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        sys.stdout.flush()
+        with open(join(self.dir, name), 'rb', 65536) as file:
+            shutil.copyfileobj(file, out, 65536)
+        out.flush()
 
     def dump_log(self):
         self.dump_file("stdout")
@@ -971,18 +1702,107 @@ class OldTest(Test):
         print()
 
     def list_files(self, glob=None, text_only=True):
-        for root, dirs, files in os.walk(self.dir):
-            for file in files:
-                name = relpath(join(root, file), self.dir)
-                if not glob or fnmatch.fnmatch(name, glob):
-                    if not text_only or name == glob or utils.guess_is_text_file(join(root, file)):
-                        yield name
+        pattern = re.compile(fnmatch.translate(glob)) if glob else None
+        for name, path, dir_fd in self.walk_files():
+            if not pattern or pattern.match(name):
+                if not text_only or name == glob or guess_is_text_file_at(path, dir_fd):
+                    yield name
+
+    # Yield the name of each file in the test's dir, with a path to open it
+    # relative to dir_fd, or on its own when there is no fwalk to give one
+    def walk_files(self):
+        # the paths all start with the test's dir and a separator
+        prefix = len(join(self.dir, ''))
+        if hasattr(os, 'fwalk'):
+            for root, dirs, files, dir_fd in os.fwalk(self.dir):
+                root = join(root, '')[prefix:]
+                for file in files:
+                    yield root + file, file, dir_fd
+            return
+        dirs = [self.dir]
+        while dirs:
+            try:
+                entries = scandir(dirs.pop())
+            except OSError:
+                continue # like os.walk, skip the dirs that can't be read
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                        continue
+                    yield entry.path[prefix:], entry.path, None
+
+# A test that has already run with --compact-results. Its small log files
+# are in its record from the results log, the others are still in its dir
+class CompactTest(OldTest):
+    def __init__(self, dir, record, **kwargs):
+        OldTest.__init__(self, dir, **kwargs)
+        self.files = dict((name, base64.b64decode(data)) for name, data in record['files'].items())
+
+    def read_file(self, name, default=None):
+        if name in self.files:
+            data = self.files[name]
+            return data if isinstance(data, str) else data.decode('utf-8', 'replace')
+        return OldTest.read_file(self, name, default)
+
+    def passed(self):
+        return 'fail_message' not in self.files and OldTest.passed(self)
+
+    def killed(self):
+        return 'killed' in self.files or OldTest.killed(self)
+
+    def dump_file(self, name):
+        if name in self.files:
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            sys.stdout.flush()
+            out.write(self.files[name])
+            out.flush()
+        else:
+            OldTest.dump_file(self, name)
+
+    def list_files(self, glob=None, text_only=True):
+        for name in sorted(self.files):
+            if not glob or fnmatch.fnmatch(name, glob):
+                yield name
+        if os.path.isdir(self.dir):
+            for name in OldTest.list_files(self, glob, text_only):
+                yield name
+
+# Suffixes of the files left by tests that are known to be text or not, the
+# start of the other files is read to guess
+text_suffixes = frozenset(['.log', '.txt', '.out', '.err'])
+binary_suffixes = frozenset(['.gz', '.bin', '.core'])
+
+# Files that can't be read, such as dangling links, are not text
+def guess_is_text_file_at(path, dir_fd=None):
+    suffix = os.path.splitext(path)[1]
+    if suffix in text_suffixes:
+        return True
+    if suffix in binary_suffixes:
+        return False
+    try:
+        if dir_fd is None:
+            if os.lstat(path).st_size == 0:
+                return True
+            return utils.guess_is_text_file(path)
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            data = os.read(fd, 100)
+        finally:
+            os.close(fd)
+    except EnvironmentError:
+        return False
+    return utils.guess_is_text_data(data)
+
+# The patterns of the group files already read, by path, mtime and size
+group_cache = {}
 
 def group_from_file(path):
-    patterns = []
-    with open(path) as f:
-        for line in f:
-            line = line.split('#')[0]
-            if line:
-                patterns += line.split()
-    return patterns
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    if key not in group_cache:
+        with open(path) as f:
+            data = f.read()
+        group_cache[key] = tuple(re.sub('#[^\n]*', '', data).split())
+    return list(group_cache[key])
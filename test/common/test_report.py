@@ -20,7 +20,12 @@ def format_tests(test_root, test_tree):
       for rel_path in test.list_files(text_only=False):
           path = os.path.join(test_root, name, rel_path)
           file_info = { 'name': os.path.join(name, rel_path) }
-          if utils.guess_is_text_file(path) and os.path.getsize(path) > 0:
+          if not os.path.exists(path):
+            # saved in the results log by --compact-results
+            contents = test.read_file(rel_path)
+            if contents:
+              file_info['contents'] = contents
+          elif utils.guess_is_text_file(path) and os.path.getsize(path) > 0:
             file_info['contents'] = open(path, "rb").read()
           file_infos.append(file_info)
 
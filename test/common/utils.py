@@ -94,10 +94,12 @@ def print_with_time(*args, **kwargs): # add timing information to print statemen
     sys.stdout.flush()
 
 def guess_is_text_file(name):
-    with file(name, 'rb') as f:
-        data = f.read(100)
-    for byte in data:
-        if ord(byte) in non_text_bytes:
+    with open(name, 'rb') as f:
+        return guess_is_text_data(f.read(100))
+
+def guess_is_text_data(data):
+    for byte in bytearray(data):
+        if byte in non_text_bytes:
             return False
     return True
 